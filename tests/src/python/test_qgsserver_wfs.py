@@ -26,50 +26,203 @@ import urllib.request
 import urllib.parse
 import urllib.error
 
-from qgis.server import QgsServerRequest
+from pathlib import Path
 
-from qgis.testing import unittest
-from qgis.PyQt.QtCore import QSize
+from qgis.server import QgsServer, QgsServerRequest, QgsBufferServerRequest, QgsBufferServerResponse
 
-import osgeo.gdal  # NOQA
+from qgis.testing import unittest
 
 from test_qgsserver import QgsServerTestBase
+from utilities import unitTestDataPath
+
+# Strip path because it may vary
+RE_STRIP_MAP = re.compile(rb'MAP=[^"&\s]+')
+# Strip the timestamp of hits responses because it changes at each request
+RE_TIMESTAMP = re.compile(rb'timeStamp="\d+-\d+-\d+T\d+:\d+:\d+"')
+# Extract online resources URLs from GetCapabilities responses
+RE_ONLINE_RESOURCE = re.compile(rb'onlineResource="([^"]*)"')
+
+
+def _strip_uncheckable(buf):
+    """Strip project path and content length because they may vary"""
+    # The project path may be echoed several times (online resources,
+    # schema locations...), only run the regex when there is one
+    if b'MAP=' in buf:
+        buf = RE_STRIP_MAP.sub(b'', buf)
+    return b'\n'.join(line for line in buf.split(b'\n') if not line.startswith(b'Content-Length:'))
+
+
+def _build_qs(project, **params):
+    """Build a query string for project, MAP comes first followed by params in order"""
+    return urllib.parse.urlencode([('MAP', project)] + list(params.items()), safe='/', quote_via=urllib.parse.quote)
+
+
+# GetFeature POST requests templates: the request is built by concatenating
+# the prefix, the GetFeature attributes and one of the suffixes
+POST_GETFEATURE_PREFIX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<wfs:GetFeature service="WFS" version="1.0.0" """
+
+POST_BBOX_SUFFIX = b""" xmlns:wfs="http://www.opengis.net/wfs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd">
+  <wfs:Query typeName="testlayer" xmlns:feature="http://www.qgis.org/gml">
+    <ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
+      <ogc:BBOX>
+        <ogc:PropertyName>geometry</ogc:PropertyName>
+        <gml:Envelope xmlns:gml="http://www.opengis.net/gml">
+          <gml:lowerCorner>8 44</gml:lowerCorner>
+          <gml:upperCorner>9 45</gml:upperCorner>
+        </gml:Envelope>
+      </ogc:BBOX>
+    </ogc:Filter>
+  </wfs:Query>
+</wfs:GetFeature>
+"""
+
+POST_SRS_SUFFIX = b""" xmlns:wfs="http://www.opengis.net/wfs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd">
+  <wfs:Query typeName="testlayer" srsName="EPSG:3857" xmlns:feature="http://www.qgis.org/gml">
+    <ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
+      <ogc:BBOX>
+        <ogc:PropertyName>geometry</ogc:PropertyName>
+        <gml:Envelope xmlns:gml="http://www.opengis.net/gml">
+          <gml:lowerCorner>8 44</gml:lowerCorner>
+          <gml:upperCorner>9 45</gml:upperCorner>
+        </gml:Envelope>
+      </ogc:BBOX>
+    </ogc:Filter>
+  </wfs:Query>
+</wfs:GetFeature>
+"""
+
+POST_SORT_SUFFIX = b""" xmlns:wfs="http://www.opengis.net/wfs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd">
+  <wfs:Query typeName="testlayer" xmlns:feature="http://www.qgis.org/gml">
+    <ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
+      <ogc:BBOX>
+        <ogc:PropertyName>geometry</ogc:PropertyName>
+        <gml:Envelope xmlns:gml="http://www.opengis.net/gml">
+          <gml:lowerCorner>8 44</gml:lowerCorner>
+          <gml:upperCorner>9 45</gml:upperCorner>
+        </gml:Envelope>
+      </ogc:BBOX>
+    </ogc:Filter>
+    <ogc:SortBy>
+      <ogc:SortProperty>
+        <ogc:PropertyName>id</ogc:PropertyName>
+        <ogc:SortOrder>DESC</ogc:SortOrder>
+      </ogc:SortProperty>
+    </ogc:SortBy>
+  </wfs:Query>
+</wfs:GetFeature>
+"""
+
 
-# Strip path and content length because path may vary
-RE_STRIP_UNCHECKABLE = b'MAP=[^"]+|Content-Length: \d+'
-RE_ATTRIBUTES = b'[^>\s]+=[^>\s]+'
+# (request id, query string) of the GetFeature requests to check against
+# the wfs_getfeature_<request id>.txt reference files
+GETFEATURE_TESTS = [
+    ('nobbox', 'GetFeature&TYPENAME=testlayer'),
+    ('startindex2', 'GetFeature&TYPENAME=testlayer&STARTINDEX=2'),
+    ('limit2', 'GetFeature&TYPENAME=testlayer&MAXFEATURES=2'),
+    ('start1_limit1', 'GetFeature&TYPENAME=testlayer&MAXFEATURES=1&STARTINDEX=1'),
+    ('srsname', 'GetFeature&TYPENAME=testlayer&SRSNAME=EPSG:3857'),
+    ('sortby', 'GetFeature&TYPENAME=testlayer&SORTBY=id D'),
+    ('hits', 'GetFeature&TYPENAME=testlayer&RESULTTYPE=hits'),
+]
+
+# (request id, POST data) of the GetFeature POST requests
+GETFEATURE_POST_TESTS = [
+    ('nobbox_post', POST_GETFEATURE_PREFIX + POST_BBOX_SUFFIX),
+    ('startindex2_post', POST_GETFEATURE_PREFIX + b'startIndex="2"' + POST_BBOX_SUFFIX),
+    ('limit2_post', POST_GETFEATURE_PREFIX + b'maxFeatures="2"' + POST_BBOX_SUFFIX),
+    ('start1_limit1_post', POST_GETFEATURE_PREFIX + b'startIndex="1" maxFeatures="1"' + POST_BBOX_SUFFIX),
+    ('srsname_post', POST_GETFEATURE_PREFIX + POST_SRS_SUFFIX),
+    ('sortby_post', POST_GETFEATURE_PREFIX + POST_SORT_SUFFIX),
+]
 
 
 class TestQgsServerWFS(QgsServerTestBase):
 
     """QGIS Server WFS Tests"""
 
-    def wfs_request_compare(self, request, version=''):
-        project = self.testdata_path + "test_project_wfs.qgs"
-        assert os.path.exists(project), "Project file not found: " + project
+    @classmethod
+    def setUpClass(cls):
+        """Check the test projects and create the server once for all tests"""
+        super().setUpClass()
+        cls.testdata_path = unitTestDataPath('qgis_server') + '/'
+        cls._wfs_project = cls.testdata_path + "test_project_wfs.qgs"
+        assert os.path.exists(cls._wfs_project), "Project file not found: " + cls._wfs_project
+        cls._wfs_project_quoted = urllib.parse.quote(cls._wfs_project)
+        cls._project_without_urls = cls.testdata_path + "test_project_without_urls.qgs"
+        cls._project_with_urls = cls.testdata_path + "test_project_with_urls.qgs"
+        # Reference files content, by path
+        cls._ref_cache = {}
+
+        # The WFS tests only read the projects, a single server can be
+        # shared by all of them
+        cls._clean_env()
+        cls._server = QgsServer()
+        # Warm up the server and the project cache
+        request = QgsBufferServerRequest('?MAP=%s&SERVICE=WFS&REQUEST=GetCapabilities' % cls._wfs_project_quoted,
+                                         QgsServerRequest.GetMethod, {}, None)
+        cls._server.handleRequest(request, QgsBufferServerResponse())
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run after all tests"""
+        del cls._server
+        super().tearDownClass()
+
+    @staticmethod
+    def _clean_env():
+        # Clean env just to be sure
+        for ev in ['QUERY_STRING', 'QGIS_PROJECT_FILE']:
+            if ev in os.environ:
+                del os.environ[ev]
+
+    def setUp(self):
+        """Reuse the server instance created in setUpClass"""
+        self._clean_env()
+        self.server = self._server
+
+    def _read_reference(self, reference_path):
+        """Read a reference file, the content is cached for the whole test case"""
+        if reference_path not in self._ref_cache:
+            self._ref_cache[reference_path] = Path(reference_path).read_bytes()
+        return self._ref_cache[reference_path]
+
+    def _maybe_store(self, reference_path, response):
+        """Store the reference file when regenerating references and its content changed"""
+        if not self.regenerate_reference:
+            return
+        if os.path.exists(reference_path) and self._read_reference(reference_path) == response:
+            return
+        self.store_reference(reference_path, response)
+        self._ref_cache.pop(reference_path, None)
+
+    def _fast_xml_equal(self, response, expected, msg):
+        """Compare XML, skipping the line by line comparison when the content is identical"""
+        if response == expected:
+            return
+        self.assertXMLEqual(response, expected, msg=msg)
+
+    def _compare_against_reference(self, reference_name, header, body, msg):
+        """Compare a response to the reference_name reference file"""
+        self.assert_headers(header, body)
+        response = header + body
+        reference_path = self.testdata_path + reference_name
+        self._maybe_store(reference_path, response)
+        expected = self._read_reference(reference_path)
+        self._fast_xml_equal(_strip_uncheckable(response), _strip_uncheckable(expected), msg)
 
-        query_string = '?MAP=%s&SERVICE=WFS&REQUEST=%s' % (urllib.parse.quote(project), request)
+    def wfs_request_compare(self, request, version=''):
+        query_string = '?MAP=%s&SERVICE=WFS&REQUEST=%s' % (self._wfs_project_quoted, request)
         if version:
             query_string += '&VERSION=%s' % version
         header, body = self._execute_request(query_string)
-        self.assert_headers(header, body)
-        response = header + body
 
         reference_name = 'wfs_' + request.lower()
         if version == '1.0.0':
             reference_name += '_1_0_0'
         reference_name += '.txt'
 
-        reference_path = self.testdata_path + reference_name
-
-        self.store_reference(reference_path, response)
-        f = open(reference_path, 'rb')
-        expected = f.read()
-        f.close()
-        response = re.sub(RE_STRIP_UNCHECKABLE, b'', response)
-        expected = re.sub(RE_STRIP_UNCHECKABLE, b'', expected)
-
-        self.assertXMLEqual(response, expected, msg="request %s failed.\n Query: %s" % (query_string, request))
+        self._compare_against_reference(reference_name, header, body, "request %s failed.\n Query: %s" % (query_string, request))
 
     def test_project_wfs(self):
         """Test some WFS request"""
@@ -78,174 +231,82 @@ class TestQgsServerWFS(QgsServerTestBase):
             self.wfs_request_compare(request, '1.0.0')
 
     def wfs_getfeature_compare(self, requestid, request):
-        project = self.testdata_path + "test_project_wfs.qgs"
-        assert os.path.exists(project), "Project file not found: " + project
-
-        query_string = '?MAP=%s&SERVICE=WFS&VERSION=1.0.0&REQUEST=%s' % (urllib.parse.quote(project), request)
+        query_string = '?MAP=%s&SERVICE=WFS&VERSION=1.0.0&REQUEST=%s' % (self._wfs_project_quoted, request)
         header, body = self._execute_request(query_string)
 
         if requestid == 'hits':
-            body = re.sub(b'timeStamp="\d+-\d+-\d+T\d+:\d+:\d+"', b'timeStamp="****-**-**T**:**:**"', body)
+            body = RE_TIMESTAMP.sub(b'timeStamp="****-**-**T**:**:**"', body)
 
-        self.result_compare(
+        self._compare_against_reference(
             'wfs_getfeature_' + requestid + '.txt',
-            "request %s failed.\n Query: %s" % (
+            header, body,
+            "request %s failed.\n Query: %s\n" % (
                 query_string,
                 request,
-            ),
-            header, body
+            )
         )
 
-    def test_getfeature(self):
-        tests = []
-        tests.append(('nobbox', 'GetFeature&TYPENAME=testlayer'))
-        tests.append(('startindex2', 'GetFeature&TYPENAME=testlayer&STARTINDEX=2'))
-        tests.append(('limit2', 'GetFeature&TYPENAME=testlayer&MAXFEATURES=2'))
-        tests.append(('start1_limit1', 'GetFeature&TYPENAME=testlayer&MAXFEATURES=1&STARTINDEX=1'))
-        tests.append(('srsname', 'GetFeature&TYPENAME=testlayer&SRSNAME=EPSG:3857'))
-        tests.append(('sortby', 'GetFeature&TYPENAME=testlayer&SORTBY=id D'))
-        tests.append(('hits', 'GetFeature&TYPENAME=testlayer&RESULTTYPE=hits'))
-
-        for id, req in tests:
-            self.wfs_getfeature_compare(id, req)
-
     def test_wfs_getcapabilities_100_url(self):
         """Check that URL in GetCapabilities response is complete"""
         # empty url in project
-        project = os.path.join(self.testdata_path, "test_project_without_urls.qgs")
-        qs = "?" + "&".join(["%s=%s" % i for i in list({
-            "MAP": urllib.parse.quote(project),
-            "SERVICE": "WFS",
-            "VERSION": "1.0.0",
-            "REQUEST": "GetCapabilities"
-        }.items())])
+        qs = "?" + _build_qs(self._project_without_urls, SERVICE="WFS", VERSION="1.0.0", REQUEST="GetCapabilities")
 
         r, h = self._result(self._execute_request(qs))
 
-        for item in str(r).split("\\n"):
-            if "onlineResource" in item:
-                self.assertEqual("onlineResource=\"?" in item, True)
+        urls = RE_ONLINE_RESOURCE.findall(r)
+        self.assertTrue(urls)
+        self.assertTrue(all(url.startswith(b'?') for url in urls), urls)
 
         # url well defined in query string
-        project = os.path.join(self.testdata_path, "test_project_without_urls.qgs")
-        qs = "https://www.qgis-server.org?" + "&".join(["%s=%s" % i for i in list({
-            "MAP": urllib.parse.quote(project),
-            "SERVICE": "WFS",
-            "VERSION": "1.0.0",
-            "REQUEST": "GetCapabilities"
-        }.items())])
+        qs = "https://www.qgis-server.org?" + _build_qs(self._project_without_urls, SERVICE="WFS", VERSION="1.0.0", REQUEST="GetCapabilities")
 
         r, h = self._result(self._execute_request(qs))
 
-        for item in str(r).split("\\n"):
-            if "onlineResource" in item:
-                self.assertTrue("onlineResource=\"https://www.qgis-server.org?" in item, True)
+        urls = RE_ONLINE_RESOURCE.findall(r)
+        self.assertTrue(urls)
+        self.assertTrue(all(url.startswith(b'https://www.qgis-server.org?') for url in urls), urls)
 
         # url well defined in project
-        project = os.path.join(self.testdata_path, "test_project_with_urls.qgs")
-        qs = "?" + "&".join(["%s=%s" % i for i in list({
-            "MAP": urllib.parse.quote(project),
-            "SERVICE": "WFS",
-            "VERSION": "1.0.0",
-            "REQUEST": "GetCapabilities"
-        }.items())])
+        qs = "?" + _build_qs(self._project_with_urls, SERVICE="WFS", VERSION="1.0.0", REQUEST="GetCapabilities")
 
         r, h = self._result(self._execute_request(qs))
 
-        for item in str(r).split("\\n"):
-            if "onlineResource" in item:
-                self.assertEqual("onlineResource=\"my_wfs_advertised_url\"" in item, True)
-
-    def result_compare(self, file_name, error_msg_header, header, body):
-        self.assert_headers(header, body)
-        response = header + body
-        reference_path = self.testdata_path + file_name
-        self.store_reference(reference_path, response)
-        f = open(reference_path, 'rb')
-        expected = f.read()
-        f.close()
-        response = re.sub(RE_STRIP_UNCHECKABLE, b'', response)
-        expected = re.sub(RE_STRIP_UNCHECKABLE, b'', expected)
-        self.assertXMLEqual(response, expected, msg="%s\n" % (error_msg_header))
-
-    def wfs_getfeature_post_compare(self, requestid, request):
-        project = self.testdata_path + "test_project_wfs.qgs"
-        assert os.path.exists(project), "Project file not found: " + project
+        urls = RE_ONLINE_RESOURCE.findall(r)
+        self.assertTrue(urls)
+        self.assertTrue(all(url == b'my_wfs_advertised_url' for url in urls), urls)
 
-        query_string = '?MAP={}'.format(urllib.parse.quote(project))
-        header, body = self._execute_request(query_string, requestMethod=QgsServerRequest.PostMethod, data=request.encode('utf-8'))
+    def wfs_getfeature_post_compare(self, requestid, data):
+        query_string = '?MAP={}'.format(self._wfs_project_quoted)
+        header, body = self._execute_request(query_string, requestMethod=QgsServerRequest.PostMethod, data=data)
 
-        self.result_compare(
+        self._compare_against_reference(
             'wfs_getfeature_{}.txt'.format(requestid),
-            "GetFeature in POST for '{}' failed.".format(requestid),
             header, body,
+            "GetFeature in POST for '{}' failed.\n".format(requestid),
         )
 
-    def test_getfeature_post(self):
-        template = """<?xml version="1.0" encoding="UTF-8"?>
-<wfs:GetFeature service="WFS" version="1.0.0" {} xmlns:wfs="http://www.opengis.net/wfs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd">
-  <wfs:Query typeName="testlayer" xmlns:feature="http://www.qgis.org/gml">
-    <ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
-      <ogc:BBOX>
-        <ogc:PropertyName>geometry</ogc:PropertyName>
-        <gml:Envelope xmlns:gml="http://www.opengis.net/gml">
-          <gml:lowerCorner>8 44</gml:lowerCorner>
-          <gml:upperCorner>9 45</gml:upperCorner>
-        </gml:Envelope>
-      </ogc:BBOX>
-    </ogc:Filter>
-  </wfs:Query>
-</wfs:GetFeature>
-"""
 
-        tests = []
-        tests.append(('nobbox_post', template.format("")))
-        tests.append(('startindex2_post', template.format('startIndex="2"')))
-        tests.append(('limit2_post', template.format('maxFeatures="2"')))
-        tests.append(('start1_limit1_post', template.format('startIndex="1" maxFeatures="1"')))
+def _getfeature_test(requestid, request):
+    def test(self):
+        self.wfs_getfeature_compare(requestid, request)
+    test.__doc__ = "Test GetFeature request '{}'".format(requestid)
+    return test
 
-        srsTemplate = """<?xml version="1.0" encoding="UTF-8"?>
-<wfs:GetFeature service="WFS" version="1.0.0" {} xmlns:wfs="http://www.opengis.net/wfs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd">
-  <wfs:Query typeName="testlayer" srsName="EPSG:3857" xmlns:feature="http://www.qgis.org/gml">
-    <ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
-      <ogc:BBOX>
-        <ogc:PropertyName>geometry</ogc:PropertyName>
-        <gml:Envelope xmlns:gml="http://www.opengis.net/gml">
-          <gml:lowerCorner>8 44</gml:lowerCorner>
-          <gml:upperCorner>9 45</gml:upperCorner>
-        </gml:Envelope>
-      </ogc:BBOX>
-    </ogc:Filter>
-  </wfs:Query>
-</wfs:GetFeature>
-"""
-        tests.append(('srsname_post', srsTemplate.format("")))
 
-        sortTemplate = """<?xml version="1.0" encoding="UTF-8"?>
-<wfs:GetFeature service="WFS" version="1.0.0" {} xmlns:wfs="http://www.opengis.net/wfs" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd">
-  <wfs:Query typeName="testlayer" xmlns:feature="http://www.qgis.org/gml">
-    <ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
-      <ogc:BBOX>
-        <ogc:PropertyName>geometry</ogc:PropertyName>
-        <gml:Envelope xmlns:gml="http://www.opengis.net/gml">
-          <gml:lowerCorner>8 44</gml:lowerCorner>
-          <gml:upperCorner>9 45</gml:upperCorner>
-        </gml:Envelope>
-      </ogc:BBOX>
-    </ogc:Filter>
-    <ogc:SortBy>
-      <ogc:SortProperty>
-        <ogc:PropertyName>id</ogc:PropertyName>
-        <ogc:SortOrder>DESC</ogc:SortOrder>
-      </ogc:SortProperty>
-    </ogc:SortBy>
-  </wfs:Query>
-</wfs:GetFeature>
-"""
-        tests.append(('sortby_post', sortTemplate.format("")))
+def _getfeature_post_test(requestid, data):
+    def test(self):
+        self.wfs_getfeature_post_compare(requestid, data)
+    test.__doc__ = "Test GetFeature in POST request '{}'".format(requestid)
+    return test
+
+
+# One test method per GetFeature request, so that a failure does not hide
+# the following requests and the requests can be run independently
+for requestid, request in GETFEATURE_TESTS:
+    setattr(TestQgsServerWFS, 'test_getfeature_' + requestid, _getfeature_test(requestid, request))
 
-        for id, req in tests:
-            self.wfs_getfeature_post_compare(id, req)
+for requestid, data in GETFEATURE_POST_TESTS:
+    setattr(TestQgsServerWFS, 'test_getfeature_' + requestid, _getfeature_post_test(requestid, data))
 
 
 if __name__ == '__main__':